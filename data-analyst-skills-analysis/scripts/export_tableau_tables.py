@@ -3,7 +3,9 @@ Export aggregated tables for Tableau dashboard.
 
 Run from project root: python scripts/export_tableau_tables.py
 
-Output: CSV files in outputs/ folder.
+Output: CSV files in outputs/ folder
+(EXPORT_FMT=parquet writes Snappy-compressed Parquet instead).
+Parsed source data is cached in outputs/.cache/ until the source CSV changes.
 
 Table → Visualization mapping:
   fact_job_postings           — KPI cards, filters, histogram (skills_count)
@@ -20,15 +22,35 @@ Table → Visualization mapping:
   agg_skills_count_by_exp     — Box plot / сводка по experience
 """
 
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+from numba import njit, prange
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 
 # Paths
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 DATA_PATH = PROJECT_ROOT / "data" / "processed" / "jsearch_cleaned_with_skills.csv"
 OUTPUT_DIR = PROJECT_ROOT / "outputs"
+OUTPUT_FORMAT = os.environ.get("EXPORT_FMT", "csv")
+CACHE_DIR = OUTPUT_DIR / ".cache"
+# Увеличить при изменении того, как read_source() строит df / skill_mat (dtype, категории)
+CACHE_VERSION = 1
+
+SKILL_PREFIX = "skill_"
+
+# Columns of the fact table (skills_count is derived after load)
+FACT_COLS = [
+    "id", "title", "country_name", "country_code", "experience_group",
+    "is_remote", "is_full_time", "is_part_time", "is_contractor", "is_internship",
+    "skills_count", "posted_at_datetime_utc"
+]
 
 SKILL_CATEGORIES = {
     "Programming": ["sql", "python", "r"],
@@ -53,42 +75,160 @@ SKILL_CATEGORIES = {
 }
 
 
+@njit(parallel=True, boundscheck=False, cache=True)
+def count_skills_and_categories(mat, cat_cols_flat, cat_offsets, out_count, out_cat):
+    """One pass over skill_mat: skills per row and category hits per row."""
+    n_rows, n_skills = mat.shape
+    n_cats = len(cat_offsets) - 1
+    for i in prange(n_rows):
+        total = 0
+        for j in range(n_skills):
+            total += mat[i, j]
+        out_count[i] = total
+        for k in range(n_cats):
+            hit = 0
+            for p in range(cat_offsets[k], cat_offsets[k + 1]):
+                if mat[i, cat_cols_flat[p]]:
+                    hit = 1
+                    break
+            out_cat[i, k] = hit
+
+
+def write_table(df, name, columns=None, chunk_size=None):
+    """Write a DataFrame to OUTPUT_DIR as CSV or Parquet (per OUTPUT_FORMAT).
+
+    columns selects a subset without copying df; chunk_size converts and writes
+    that many rows at a time, so only one chunk is held in Arrow memory.
+    """
+    step = chunk_size or max(len(df), 1)
+    # Table, а не RecordBatch: колонки с pyarrow-строками приходят как ChunkedArray
+    chunk = pa.Table.from_pandas(df.iloc[:step], columns=columns, preserve_index=False)
+    schema = chunk.schema
+    if OUTPUT_FORMAT == "parquet":
+        path = OUTPUT_DIR / f"{name}.parquet"
+        writer = pq.ParquetWriter(path, schema, compression="snappy")
+    else:
+        path = OUTPUT_DIR / f"{name}.csv"
+        writer = pa_csv.CSVWriter(path, schema)
+    with writer:
+        writer.write_table(chunk)
+        # Последующие чанки приводятся к схеме первого, чтобы типы совпадали
+        for start in range(step, len(df), step):
+            chunk = pa.Table.from_pandas(
+                df.iloc[start:start + step], schema=schema, preserve_index=False
+            )
+            writer.write_table(chunk)
+    return path
+
+
+def source_columns():
+    """Read only the header of DATA_PATH and return (skill_cols, usecols)."""
+    header = pd.read_csv(DATA_PATH, nrows=0).columns
+    skill_cols = [c for c in header if c.startswith(SKILL_PREFIX)]
+    needed = set(FACT_COLS) | set(skill_cols) | {"country_name", "experience_group"}
+    usecols = [c for c in header if c in needed]
+    return skill_cols, usecols
+
+
+def read_source(skill_cols, usecols):
+    """Parse DATA_PATH into (df without skill_* columns, skill_mat as int8)."""
+    # Читаем только нужные колонки; skill_* — флаги 0/1, храним как int8
+    df = pd.read_csv(
+        DATA_PATH,
+        engine="pyarrow",
+        usecols=usecols,
+        dtype={c: "int8" for c in skill_cols},
+        parse_dates=["posted_at_datetime_utc"],
+    )
+    # Категориальные коды ускоряют все groupby / value_counts ниже
+    df["experience_group"] = df["experience_group"].astype("category")
+    df["country_name"] = df["country_name"].astype("category")
+
+    # Матрица навыков (N × S, int8) — одна плотная копия для всех агрегатов
+    # Дальше навыки читаются только из skill_mat: skill_* убираем из df, чтобы
+    # не держать вторую копию и не пересрезать df[skill_cols] в секциях
+    skill_mat = np.ascontiguousarray(df[skill_cols].to_numpy(dtype=np.int8, copy=False))
+    df = df.drop(columns=skill_cols)
+    return df, skill_mat
+
+
+def load_data():
+    """Load the source table, reusing the on-disk cache while DATA_PATH is unchanged.
+
+    The cache holds skill_mat as .npy (memory-mapped on load) and the remaining
+    columns as Feather, with categoricals preserved, so re-runs skip the CSV parse.
+    It is keyed on the source file, the selected columns and CACHE_VERSION.
+    """
+    skill_cols, usecols = source_columns()
+    stat = DATA_PATH.stat()
+    source_key = {
+        "version": CACHE_VERSION,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "usecols": usecols,
+    }
+    meta_path = CACHE_DIR / "meta.json"
+    frame_path = CACHE_DIR / "frame.feather"
+    skill_mat_path = CACHE_DIR / "skill_mat.npy"
+    if meta_path.exists() and frame_path.exists() and skill_mat_path.exists():
+        meta = json.loads(meta_path.read_text())
+        if meta.get("source") == source_key:
+            df = pd.read_feather(frame_path)
+            skill_mat = np.load(skill_mat_path, mmap_mode="r")
+            return df, skill_cols, skill_mat
+
+    df, skill_mat = read_source(skill_cols, usecols)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    meta_path.unlink(missing_ok=True)
+    df.to_feather(frame_path)
+    np.save(skill_mat_path, skill_mat)
+    # meta.json пишется последним: пока его нет, кэш считается невалидным
+    meta_path.write_text(json.dumps({"source": source_key}))
+    return df, skill_cols, skill_mat
+
+
 def main():
+    if OUTPUT_FORMAT not in ("csv", "parquet"):
+        raise ValueError(f"Unsupported EXPORT_FMT: {OUTPUT_FORMAT!r} (expected 'csv' or 'parquet')")
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-    df = pd.read_csv(DATA_PATH)
-    df["posted_at_datetime_utc"] = pd.to_datetime(df["posted_at_datetime_utc"])
+    df, skill_cols, skill_mat = load_data()
+    skill_names = [c[len(SKILL_PREFIX):] for c in skill_cols]
+    skill_name_map = dict(zip(skill_cols, skill_names))
 
-    skill_cols = [c for c in df.columns if c.startswith("skill_")]
-    df["skills_count"] = df[skill_cols].sum(axis=1)
+    # Матрица категорий (N × K, int8): 1, если в вакансии есть хотя бы один навык категории.
+    # skills_count и cat_mat считаются за один проход по skill_mat
+    col_pos = {c: i for i, c in enumerate(skill_cols)}
+    cat_idx = {
+        category: [col_pos[SKILL_PREFIX + s] for s in skills if SKILL_PREFIX + s in col_pos]
+        for category, skills in SKILL_CATEGORIES.items()
+    }
+    cat_idx = {category: idx for category, idx in cat_idx.items() if idx}
+    cat_cols_flat = np.array([i for idx in cat_idx.values() for i in idx], dtype=np.int32)
+    cat_offsets = np.cumsum([0] + [len(idx) for idx in cat_idx.values()]).astype(np.int32)
+    skills_count = np.empty(len(df), dtype=np.int32)
+    cat_mat = np.empty((len(df), len(cat_idx)), dtype=np.int8)
+    count_skills_and_categories(skill_mat, cat_cols_flat, cat_offsets, skills_count, cat_mat)
+    df["skills_count"] = skills_count
     n_total = len(df)
+    jobs = []  # (DataFrame, имя таблицы, kwargs для write_table)
 
     # -------------------------------------------------------------------------
     # 1. fact_job_postings — базовая таблица для KPI, фильтров, drill-down
     # KPI cards, histogram skills per posting, фильтры по country/experience
     # -------------------------------------------------------------------------
-    fact_cols = [
-        "id", "title", "country_name", "country_code", "experience_group",
-        "is_remote", "is_full_time", "is_part_time", "is_contractor", "is_internship",
-        "skills_count", "posted_at_datetime_utc"
-    ]
-    fact_cols = [c for c in fact_cols if c in df.columns]
-    fact_job_postings = df[fact_cols].copy()
-    fact_job_postings.to_csv(OUTPUT_DIR / "fact_job_postings.csv", index=False)
-    print(f"Saved: fact_job_postings.csv ({len(fact_job_postings)} rows)")
+    fact_cols = [c for c in FACT_COLS if c in df.columns]
+    jobs.append((df, "fact_job_postings", {"columns": fact_cols, "chunk_size": 65536}))
 
     # -------------------------------------------------------------------------
     # 2. agg_country — распределение по странам (bar, pie, donut)
     # -------------------------------------------------------------------------
-    agg_country = (
-        df["country_name"]
-        .value_counts()
-        .reset_index()
-    )
+    # Число вакансий по странам — также знаменатель для долей в секции 6
+    country_totals = df["country_name"].value_counts()
+    agg_country = country_totals.reset_index()
     agg_country.columns = ["country_name", "count"]
     agg_country["share"] = agg_country["count"] / agg_country["count"].sum() * 100
-    agg_country.to_csv(OUTPUT_DIR / "agg_country.csv", index=False)
-    print(f"Saved: agg_country.csv")
+    jobs.append((agg_country, "agg_country", {}))
 
     # -------------------------------------------------------------------------
     # 3. agg_experience — junior vs mid+ (bar, pie)
@@ -100,8 +240,7 @@ def main():
     )
     agg_experience.columns = ["experience_group", "count"]
     agg_experience["share"] = agg_experience["count"] / agg_experience["count"].sum() * 100
-    agg_experience.to_csv(OUTPUT_DIR / "agg_experience.csv", index=False)
-    print(f"Saved: agg_experience.csv")
+    jobs.append((agg_experience, "agg_experience", {}))
 
     # -------------------------------------------------------------------------
     # 4. agg_remote — remote vs on-site (для KPI)
@@ -113,85 +252,97 @@ def main():
     )
     agg_remote.columns = ["is_remote", "count"]
     agg_remote["share"] = agg_remote["count"] / agg_remote["count"].sum() * 100
-    agg_remote.to_csv(OUTPUT_DIR / "agg_remote.csv", index=False)
-    print(f"Saved: agg_remote.csv")
+    jobs.append((agg_remote, "agg_remote", {}))
 
     # -------------------------------------------------------------------------
     # 5. agg_top_skills — Top N skills (horizontal bar)
     # -------------------------------------------------------------------------
-    top_skills = df[skill_cols].agg(["sum", "mean"]).T.reset_index()
-    top_skills.columns = ["skill_name", "count", "share"]
-    top_skills["share"] = top_skills["share"] * 100
-    top_skills["skill"] = top_skills["skill_name"].str.replace("skill_", "", regex=False)
-    top_skills = top_skills.sort_values("count", ascending=False).reset_index(drop=True)
-    top_skills.to_csv(OUTPUT_DIR / "agg_top_skills.csv", index=False)
-    print(f"Saved: agg_top_skills.csv ({len(top_skills)} skills)")
+    skill_counts = skill_mat.sum(axis=0, dtype=np.int64)
+    top_skills = pd.DataFrame({
+        "skill_name": skill_cols,
+        "count": skill_counts,
+        "share": skill_counts * (100.0 / n_total),
+        "skill": skill_names,
+    })
+    top_skills = top_skills.sort_values("count", ascending=False, ignore_index=True)
+    jobs.append((top_skills, "agg_top_skills", {}))
 
     # -------------------------------------------------------------------------
     # 6. agg_skills_by_country — heatmap skills × country (long format)
     # -------------------------------------------------------------------------
-    skills_by_country = (
-        df.groupby("country_name")[skill_cols]
-        .sum()
-        .T
+    # Суммы по странам как матричное произведение one-hot(country)ᵀ × skill_mat
+    # (float32-копия skill_mat используется и в секции 7)
+    skill_mat_f32 = skill_mat.astype(np.float32)
+    country_codes = df["country_name"].cat.codes.to_numpy()
+    countries = df["country_name"].cat.categories
+    rows = np.flatnonzero(country_codes >= 0)
+    country_onehot = np.zeros((n_total, len(countries)), dtype=np.float32)
+    country_onehot[rows, country_codes[rows]] = 1.0
+    skills_by_country = pd.DataFrame(
+        (country_onehot.T @ skill_mat_f32).T.astype(np.int64),
+        index=skill_cols,
+        columns=list(countries)
     )
-    skills_by_country = skills_by_country.reset_index().rename(columns={"index": "skill_name"})
+    skills_by_country = skills_by_country.rename_axis("skill_name").reset_index()
     skills_by_country_long = skills_by_country.melt(
         id_vars="skill_name",
         var_name="country_name",
         value_name="count"
     )
-    country_totals = df.groupby("country_name").size()
-    skills_by_country_long["share"] = skills_by_country_long.apply(
-        lambda r: r["count"] / country_totals[r["country_name"]] * 100
-        if country_totals[r["country_name"]] > 0 else 0,
-        axis=1
-    )
-    skills_by_country_long["skill"] = skills_by_country_long["skill_name"].str.replace(
-        "skill_", "", regex=False
+    totals = country_totals.reindex(skills_by_country_long["country_name"]).to_numpy()
+    skills_by_country_long["share"] = np.where(
+        totals > 0,
+        skills_by_country_long["count"].to_numpy() / np.maximum(totals, 1) * 100,
+        0.0
     )
-    skills_by_country_long.to_csv(OUTPUT_DIR / "agg_skills_by_country.csv", index=False)
-    print(f"Saved: agg_skills_by_country.csv")
+    skills_by_country_long["skill"] = skills_by_country_long["skill_name"].map(skill_name_map)
+    jobs.append((skills_by_country_long, "agg_skills_by_country", {}))
 
     # -------------------------------------------------------------------------
     # 7. agg_skills_by_experience — grouped bar / heatmap junior vs mid+
     # -------------------------------------------------------------------------
-    skills_by_exp = df.groupby("experience_group")[skill_cols].mean() * 100
-    skills_by_exp = skills_by_exp.T.reset_index()
-    skills_by_exp = skills_by_exp.rename(columns={"index": "skill_name"})
-    skills_by_exp_long = skills_by_exp.melt(
+    # Доли навыков по группам считаются один раз и используются в секциях 7 и 8
+    exp_codes = df["experience_group"].cat.codes.to_numpy()
+    exp_groups = df["experience_group"].cat.categories
+    rows = np.flatnonzero(exp_codes >= 0)
+    exp_onehot = np.zeros((n_total, len(exp_groups)), dtype=np.float32)
+    exp_onehot[rows, exp_codes[rows]] = 1.0
+    exp_sizes = exp_onehot.sum(axis=0, dtype=np.float64)
+    exp_sums = (exp_onehot.T @ skill_mat_f32).astype(np.float64)
+    observed = exp_sizes > 0
+    skills_by_exp = pd.DataFrame(
+        (exp_sums[observed] / exp_sizes[observed, None] * 100).T,
+        index=skill_cols,
+        columns=list(exp_groups[observed])
+    )
+    skills_by_exp_long = skills_by_exp.rename_axis("skill_name").reset_index().melt(
         id_vars="skill_name",
         var_name="experience_group",
         value_name="share"
     )
-    skills_by_exp_long["skill"] = skills_by_exp_long["skill_name"].str.replace(
-        "skill_", "", regex=False
-    )
-    skills_by_exp_long.to_csv(OUTPUT_DIR / "agg_skills_by_experience.csv", index=False)
-    print(f"Saved: agg_skills_by_experience.csv")
+    skills_by_exp_long["skill"] = skills_by_exp_long["skill_name"].map(skill_name_map)
+    jobs.append((skills_by_exp_long, "agg_skills_by_experience", {}))
 
     # -------------------------------------------------------------------------
     # 8. agg_skills_gap — diverging bar (mid+ - junior)
     # -------------------------------------------------------------------------
-    gap_df = skills_by_exp.copy()
-    gap_df["gap"] = gap_df["mid_plus"] - gap_df["junior"]
-    gap_df["skill"] = gap_df["skill_name"].str.replace("skill_", "", regex=False)
-    gap_df = gap_df.rename(columns={"junior": "junior_share", "mid_plus": "mid_plus_share"})
-    gap_df = gap_df.sort_values("gap", key=abs, ascending=False).reset_index(drop=True)
-    gap_df.to_csv(OUTPUT_DIR / "agg_skills_gap.csv", index=False)
-    print(f"Saved: agg_skills_gap.csv")
+    gap_df = pd.DataFrame({
+        "skill_name": skills_by_exp.index,
+        "junior_share": skills_by_exp["junior"].to_numpy(),
+        "mid_plus_share": skills_by_exp["mid_plus"].to_numpy(),
+    })
+    gap_df["gap"] = gap_df["mid_plus_share"] - gap_df["junior_share"]
+    gap_df["skill"] = gap_df["skill_name"].map(skill_name_map)
+    gap_df["_abs"] = gap_df["gap"].abs()
+    gap_df = gap_df.sort_values("_abs", ascending=False, ignore_index=True).drop(columns="_abs")
+    jobs.append((gap_df, "agg_skills_gap", {}))
 
     # -------------------------------------------------------------------------
     # 9. agg_skill_categories — treemap категорий
     # -------------------------------------------------------------------------
-    category_share = {}
-    category_count = {}
-    for category, skills in SKILL_CATEGORIES.items():
-        cols = [f"skill_{s}" for s in skills if f"skill_{s}" in df.columns]
-        if cols:
-            mentioned = df[cols].max(axis=1)
-            category_share[category] = mentioned.mean() * 100
-            category_count[category] = int(mentioned.sum())
+    cat_counts = cat_mat.sum(axis=0, dtype=np.int64)
+    category_share = dict(zip(cat_idx, cat_counts / n_total * 100))
+    category_count = dict(zip(cat_idx, cat_counts.tolist()))
 
     agg_categories = (
         pd.Series(category_share)
@@ -200,53 +351,50 @@ def main():
     )
     agg_categories.columns = ["skill_category", "share"]
     agg_categories["count"] = agg_categories["skill_category"].map(category_count)
-    agg_categories.to_csv(OUTPUT_DIR / "agg_skill_categories.csv", index=False)
-    print(f"Saved: agg_skill_categories.csv")
+    jobs.append((agg_categories, "agg_skill_categories", {}))
 
     # -------------------------------------------------------------------------
     # 10. agg_skill_categories_by_experience — grouped bar категорий
     # -------------------------------------------------------------------------
-    cat_exp_records = []
-    for group in df["experience_group"].unique():
-        subset = df[df["experience_group"] == group]
-        for category, skills in SKILL_CATEGORIES.items():
-            cols = [f"skill_{s}" for s in skills if f"skill_{s}" in df.columns]
-            if cols:
-                share = subset[cols].max(axis=1).mean() * 100
-                cat_exp_records.append({
-                    "experience_group": group,
-                    "skill_category": category,
-                    "share": share
-                })
-
-    agg_cat_exp = pd.DataFrame(cat_exp_records)
-    agg_cat_exp.to_csv(OUTPUT_DIR / "agg_skill_categories_by_experience.csv", index=False)
-    print(f"Saved: agg_skill_categories_by_experience.csv")
+    agg_cat_exp = (
+        pd.DataFrame(cat_mat, columns=list(cat_idx), index=pd.CategoricalIndex(df["experience_group"]))
+        .groupby(level=0, observed=True, sort=False)
+        .mean()
+        .mul(100)
+        .stack()
+        .rename("share")
+        .rename_axis(["experience_group", "skill_category"])
+        .reset_index()
+    )
+    jobs.append((agg_cat_exp, "agg_skill_categories_by_experience", {}))
 
     # -------------------------------------------------------------------------
     # 11. agg_skills_count_dist — histogram (bins для skills per posting)
     # -------------------------------------------------------------------------
-    skills_count_dist = (
-        df["skills_count"]
-        .value_counts()
-        .sort_index()
-        .reset_index()
-    )
-    skills_count_dist.columns = ["skills_count", "count"]
+    count_freq = np.bincount(skills_count, minlength=len(skill_cols) + 1)
+    present = np.flatnonzero(count_freq)
+    skills_count_dist = pd.DataFrame({
+        "skills_count": present,
+        "count": count_freq[present],
+    })
     skills_count_dist["share"] = skills_count_dist["count"] / n_total * 100
-    skills_count_dist.to_csv(OUTPUT_DIR / "agg_skills_count_dist.csv", index=False)
-    print(f"Saved: agg_skills_count_dist.csv")
+    jobs.append((skills_count_dist, "agg_skills_count_dist", {}))
 
     # -------------------------------------------------------------------------
     # 12. agg_skills_count_by_experience — box plot / сравнение median
     # -------------------------------------------------------------------------
     skills_count_by_exp = (
-        df.groupby("experience_group")["skills_count"]
+        df.groupby("experience_group", observed=True, sort=False)["skills_count"]
         .agg(["count", "mean", "median", "min", "max"])
         .reset_index()
     )
-    skills_count_by_exp.to_csv(OUTPUT_DIR / "agg_skills_count_by_experience.csv", index=False)
-    print(f"Saved: agg_skills_count_by_experience.csv")
+    jobs.append((skills_count_by_exp, "agg_skills_count_by_experience", {}))
+
+    # Таблицы независимы: запись (C++ в pyarrow, без GIL) идёт параллельно
+    with ThreadPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+        futures = [executor.submit(write_table, table, name, **kwargs) for table, name, kwargs in jobs]
+        for (table, _, _), future in zip(jobs, futures):
+            print(f"Saved: {future.result().name} ({len(table)} rows)")
 
     print("\nAll tables exported to outputs/")
 